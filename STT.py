@@ -1,10 +1,17 @@
-import io, os
+import os
+import threading
+import time
+import wave
+import grpc
 from google.cloud import speech_v2
 import json
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request
 
 PROJECT_ID = os.getenv("PROJECT_ID", "spring-radar-474120-c4")
+RECOGNIZER = f"projects/{PROJECT_ID}/locations/global/recognizers/_"
+# StreamingRecognizeRequest.audio is limited to 15 KB per message
+MAX_STREAM_CHUNK_BYTES = 15000
 
 # # Get the directory where this script is located, then go to the key file
 # BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -35,6 +42,53 @@ def _load_credentials():
     scoped = creds.with_scopes(CLOUD_SCOPE).with_quota_project(PROJECT_ID)
     return scoped
 
+# Loaded once per process. google-auth refreshes the token lazily when it expires,
+# so no per-request refresh round-trip is needed.
+_CREDS = _load_credentials()
+_CLIENT = speech_v2.SpeechClient(credentials=_CREDS)
+
+# Tokens live ~1h; refreshing every 30 min in the background means the lazy
+# refresh above never has to happen inside a request.
+TOKEN_REFRESH_INTERVAL_S = 30 * 60
+
+def _refresh_token_forever() -> None:
+    while True:
+        try:
+            _CREDS.refresh(Request())
+        except Exception as e:
+            print(f"STT token refresh failed (will retry): {e}")
+        time.sleep(TOKEN_REFRESH_INTERVAL_S)
+
+threading.Thread(target=_refresh_token_forever, daemon=True).start()
+
+def _prewarm_channel() -> None:
+    """
+    Start connecting the gRPC channel now (DNS + TLS + HTTP/2) instead of on the first
+    recognize call. Non-blocking: the connection completes in the background.
+    """
+    try:
+        grpc.channel_ready_future(_CLIENT.transport.grpc_channel)
+    except Exception as e:
+        # e.g. a REST transport has no gRPC channel; nothing to warm
+        print(f"STT channel prewarm skipped: {e}")
+
+_prewarm_channel()
+
+def _transcript_from(results) -> str:
+    """Join the top alternative of every result into one transcript."""
+    if not results:
+        print("❌ No transcription results.")
+        return ""
+
+    text_parts = []
+    for r in results:
+        if r.alternatives:
+            text_parts.append(r.alternatives[0].transcript.strip())
+
+    transcript = " ".join(text_parts)
+    print("🗣️ Transcript:", transcript)
+    return transcript
+
 # def transcribe_wav(path: str):
 #     # 1) Load + scope creds, set quota project
 #     base = service_account.Credentials.from_service_account_file(KEY_PATH)
@@ -71,47 +125,62 @@ def _load_credentials():
 #         if r.alternatives:
 #             print("🗣️", r.alternatives[0].transcript)
 
-def transcribe_wav(path: str) -> str:
+def transcribe_wav(source) -> str:
     """
-    Transcribes an audio file (WAV, M4A, etc.) using Google Cloud Speech-to-Text v2.
-    Works on Railway using credentials from the GCP_KEY_JSON environment variable.
+    Transcribes a 16-bit PCM WAV (path or file-like) using Google Cloud Speech-to-Text v2.
+    The PCM frames are read in 100 ms slices (smaller for high-rate or multichannel
+    files, to stay under MAX_STREAM_CHUNK_BYTES) and streamed as LINEAR16 — no header,
+    no auto-detect, and the file is never held in memory as a whole.
+    Raises wave.Error for WAVs that aren't 16-bit PCM.
     """
-    # 1) Load creds and refresh token
-    scoped = _load_credentials()
-    scoped.refresh(Request())
-    print("🔐 Using SA:", scoped.service_account_email)
-
-    # 2) Initialize Speech client
-    client = speech_v2.SpeechClient(credentials=scoped)
-
-    # 3) Read audio file bytes
-    with open(path, "rb") as f:
-        audio_bytes = f.read()
-
-    # 4) Configure request
-    config = speech_v2.RecognitionConfig(
-        auto_decoding_config=speech_v2.AutoDetectDecodingConfig(),
+    with wave.open(source, "rb") as wf:
+        if wf.getsampwidth() != 2:
+            raise wave.Error(f"unsupported sample width: {wf.getsampwidth() * 8}-bit")
+        sample_rate = wf.getframerate()
+        channels = wf.getnchannels()
+        frame_bytes = channels * wf.getsampwidth()
+        frames_per_chunk = max(1, min(sample_rate // 10, MAX_STREAM_CHUNK_BYTES // frame_bytes))
+
+        def _chunks():
+            while True:
+                chunk = wf.readframes(frames_per_chunk)
+                if not chunk:
+                    return
+                yield chunk
+
+        return transcribe_pcm_stream(_chunks(), sample_rate_hertz=sample_rate, audio_channel_count=channels)
+
+def _explicit_pcm_config(sample_rate_hertz: int, audio_channel_count: int = 1) -> speech_v2.RecognitionConfig:
+    # The encoding is declared explicitly, so Google skips server-side format detection.
+    return speech_v2.RecognitionConfig(
+        explicit_decoding_config=speech_v2.ExplicitDecodingConfig(
+            encoding=speech_v2.ExplicitDecodingConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=sample_rate_hertz,
+            audio_channel_count=audio_channel_count,
+        ),
         language_codes=["en-US"],
         model="latest_long",
     )
 
-    req = speech_v2.RecognizeRequest(
-        recognizer=f"projects/{PROJECT_ID}/locations/global/recognizers/_",
-        config=config,
-        content=audio_bytes,
-    )
-
-    # 5) Send to API and parse results
-    resp = client.recognize(request=req)
-    if not resp.results:
-        print("❌ No transcription results.")
-        return ""
-
-    text_parts = []
-    for r in resp.results:
-        if r.alternatives:
-            text_parts.append(r.alternatives[0].transcript.strip())
+def transcribe_pcm_stream(chunks, sample_rate_hertz: int = 16000, audio_channel_count: int = 1) -> str:
+    """
+    Transcribes LINEAR16 PCM delivered as an iterable of small chunks
+    (e.g. m4atowav.iter_pcm_chunks) with streaming_recognize, so Google starts
+    recognizing while audio is still being decoded and uploaded.
+    """
+    client = _CLIENT
+
+    def _requests():
+        yield speech_v2.StreamingRecognizeRequest(
+            recognizer=RECOGNIZER,
+            streaming_config=speech_v2.StreamingRecognitionConfig(
+                config=_explicit_pcm_config(sample_rate_hertz, audio_channel_count),
+            ),
+        )
+        for chunk in chunks:
+            yield speech_v2.StreamingRecognizeRequest(audio=chunk)
 
-    transcript = " ".join(text_parts)
-    print("🗣️ Transcript:", transcript)
-    return transcript
+    final_results = []
+    for resp in client.streaming_recognize(requests=_requests()):
+        final_results.extend(r for r in resp.results if r.is_final)
+    return _transcript_from(final_results)
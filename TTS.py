@@ -1,5 +1,12 @@
+import hashlib
 import os
+import queue
+import tempfile
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -7,26 +14,222 @@ load_dotenv()
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 ELEVEN_VOICE_ID = os.getenv("ELEVEN_VOICE_ID")
 
+VOICE_SETTINGS = {"stability": 0.6, "similarity_boost": 0.75}
+STREAM_CHUNK_SIZE = 4096
+# (connect, read) timeouts for ElevenLabs calls
+REQUEST_TIMEOUT = (3.05, 30)
+
+# One pooled keep-alive session so every turn reuses the same TLS connection
+# instead of paying DNS + TCP + TLS handshakes again.
+_SESSION = requests.Session()
+# Sized for gunicorn threads x parallel per-sentence synthesis
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=int(os.getenv("ELEVEN_POOL_MAXSIZE", "16")),
+    max_retries=Retry(total=2, backoff_factor=0.1),
+))
+
+# Content-addressed mp3 cache: identical (voice, text, settings, format) never hits ElevenLabs twice
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tts_cache"))
+# Entries older than this are re-synthesized (and rewritten) on the next request
+TTS_CACHE_TTL_S = int(os.getenv("TTS_CACHE_TTL_S", str(30 * 24 * 3600)))
+# Expired entries that are never requested again are removed by a periodic sweep
+TTS_CACHE_SWEEP_INTERVAL_S = 3600
+_next_sweep_at = 0.0
+_sweep_lock = threading.Lock()
+# 22.05 kHz / 32 kbps mp3 is plenty for speech and ~4x smaller than the 44.1 kHz / 128 kbps default
+OUTPUT_FORMAT = os.getenv("ELEVEN_OUTPUT_FORMAT", "mp3_22050_32")
+# 0-4; higher skips more generation buffering at a small quality cost
+OPTIMIZE_STREAMING_LATENCY = int(os.getenv("ELEVEN_OPTIMIZE_STREAMING_LATENCY", "3"))
+
+
+def _cache_path(voice: str, text: str, output_format: str) -> str:
+    stab = VOICE_SETTINGS["stability"]
+    sim = VOICE_SETTINGS["similarity_boost"]
+    key = hashlib.sha256(f"{voice}|{text}|{stab}|{sim}|{output_format}".encode("utf-8")).hexdigest()
+    return os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+
+
+def _cache_read(path: str):
+    try:
+        with open(path, "rb") as f:
+            if time.time() - os.fstat(f.fileno()).st_mtime <= TTS_CACHE_TTL_S:
+                return f.read()
+    except OSError:
+        return None
+    _cache_remove(path)  # expired
+    return None
+
+
+def _cache_remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _sweep_cache() -> None:
+    """Delete expired entries (and stale partial writes) from TTS_CACHE_DIR."""
+    cutoff = time.time() - TTS_CACHE_TTL_S
+    try:
+        entries = list(os.scandir(TTS_CACHE_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                _cache_remove(entry.path)
+        except OSError:
+            pass
+
+
+def _maybe_sweep_cache() -> None:
+    """Start a background sweep at most once per TTS_CACHE_SWEEP_INTERVAL_S per process."""
+    global _next_sweep_at
+    with _sweep_lock:
+        now = time.time()
+        if now < _next_sweep_at:
+            return
+        _next_sweep_at = now + TTS_CACHE_SWEEP_INTERVAL_S
+    threading.Thread(target=_sweep_cache, daemon=True).start()
+
+
+def _cache_write(path: str, audio: bytes) -> None:
+    """Best-effort atomic write; a full or read-only disk must not fail the request."""
+    if not audio:
+        return
+    try:
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(audio)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"TTS cache write failed: {e}")
+    _maybe_sweep_cache()
+
+
+def _query_params() -> dict:
+    return {
+        "optimize_streaming_latency": OPTIMIZE_STREAMING_LATENCY,
+        "output_format": OUTPUT_FORMAT,
+    }
+
+
+def _headers() -> dict:
+    return {
+        "xi-api-key": ELEVENLABS_API_KEY,
+        "Accept": "audio/mpeg",
+        "Content-Type": "application/json"
+    }
+
 
 def elevenlabs_tts_get_bytes(text, voice_id=None) -> bytes:
-    """Call ElevenLabs and return raw mp3 bytes. Raises on failure."""
+    """Call ElevenLabs (or the disk cache) and return raw mp3 bytes. Raises on failure."""
     voice = voice_id or ELEVEN_VOICE_ID
     if not ELEVENLABS_API_KEY or not voice:
         raise RuntimeError("ELEVENLABS_API_KEY or ELEVEN_VOICE_ID not set in env")
 
+    cache_path = _cache_path(voice, text, OUTPUT_FORMAT)
+    cached = _cache_read(cache_path)
+    if cached is not None:
+        return cached
+
     url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice}"
-    headers = {
-        "xi-api-key": ELEVENLABS_API_KEY,
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json"
-    }
     payload = {
         "text": text,
-        "voice_settings": {"stability": 0.6, "similarity_boost": 0.75}
+        "voice_settings": VOICE_SETTINGS
     }
 
-    resp = requests.post(url, headers=headers, json=payload, stream=True)
+    resp = _SESSION.post(url, headers=_headers(), params=_query_params(), json=payload,
+                         timeout=REQUEST_TIMEOUT)
     if resp.status_code != 200:
         raise RuntimeError(f"ElevenLabs TTS failed ({resp.status_code}): {resp.text}")
 
-    return resp.content
\ No newline at end of file
+    _cache_write(cache_path, resp.content)
+    return resp.content
+
+
+def elevenlabs_tts_stream(text, voice_id=None):
+    """
+    Call the ElevenLabs streaming endpoint and yield mp3 chunks as they are synthesized.
+    Cache hits are replayed from disk; misses are written to the cache once complete.
+    The request is only sent once the generator is first advanced; raises on failure.
+    """
+    voice = voice_id or ELEVEN_VOICE_ID
+    if not ELEVENLABS_API_KEY or not voice:
+        raise RuntimeError("ELEVENLABS_API_KEY or ELEVEN_VOICE_ID not set in env")
+
+    cache_path = _cache_path(voice, text, OUTPUT_FORMAT)
+    cached = _cache_read(cache_path)
+    if cached is not None:
+        for i in range(0, len(cached), STREAM_CHUNK_SIZE):
+            yield cached[i:i + STREAM_CHUNK_SIZE]
+        return
+
+    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice}/stream"
+    payload = {
+        "text": text,
+        "voice_settings": VOICE_SETTINGS
+    }
+
+    with _SESSION.post(url, headers=_headers(), params=_query_params(), json=payload,
+                       stream=True, timeout=REQUEST_TIMEOUT) as resp:
+        if resp.status_code != 200:
+            raise RuntimeError(f"ElevenLabs TTS failed ({resp.status_code}): {resp.text}")
+
+        audio = bytearray()
+        for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if chunk:
+                audio += chunk
+                yield chunk
+
+    _cache_write(cache_path, bytes(audio))
+
+
+class SentenceStreamer:
+    """
+    Synthesizes sentences while the caller is still producing them and exposes the
+    resulting mp3 chunks, in sentence order, via chunks().
+    Each sentence gets its own background request as soon as it is fed, so sentence
+    N+1 is already synthesizing while sentence N is being played out.
+    Call feed() for each sentence and close() once the text is complete.
+    """
+
+    _DONE = object()
+
+    def __init__(self, voice_id=None):
+        self._voice_id = voice_id
+        # one chunk queue per sentence, in the order they were fed
+        self._sentence_queues = queue.Queue()
+
+    def feed(self, sentence: str) -> None:
+        chunks = queue.Queue()
+        self._sentence_queues.put(chunks)
+        threading.Thread(target=self._synthesize, args=(sentence, chunks), daemon=True).start()
+
+    def close(self) -> None:
+        self._sentence_queues.put(self._DONE)
+
+    def _synthesize(self, sentence: str, chunks: queue.Queue) -> None:
+        try:
+            for chunk in elevenlabs_tts_stream(sentence, self._voice_id):
+                chunks.put(chunk)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(self._DONE)
+
+    def chunks(self):
+        """Yield mp3 chunks as they arrive; re-raises any TTS error in the caller."""
+        while True:
+            sentence_chunks = self._sentence_queues.get()
+            if sentence_chunks is self._DONE:
+                return
+            while True:
+                item = sentence_chunks.get()
+                if item is self._DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
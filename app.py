@@ -1,53 +1,196 @@
-from flask import Flask, request, jsonify, send_file
-from pymongo import MongoClient
-from datetime import datetime, timezone
+from flask import Flask, Response, abort, request, jsonify, send_file, stream_with_context, url_for
+from io import BytesIO
+from flask.json.provider import DefaultJSONProvider
+import orjson
+from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from pymongo.write_concern import WriteConcern
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 import os
 from bson.objectid import ObjectId
 from flask_cors import CORS
 import requests
-import tempfile
 import base64
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 import google.generativeai as genai
 import subprocess
-import json
 import re
-
-from m4atowav import convert_m4a_to_wav 
-from STT import transcribe_wav
+import queue
+import threading
+import time
+import wave
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
+
+import cache as semantic_cache
+from m4atowav import iter_pcm_chunks
+from STT import transcribe_pcm_stream, transcribe_wav
 from gemini import (
     configure_genai,
     ensure_model_exists,
     build_system_instruction,
+    iter_sentences,
     load_scenarios,
     MODEL_ID,
     SCENARIOS_PATH,
 )
 from scenarios import (
-    SCENARIOS,
     find_scenario_key_by_title,
     get_model_for_scenario,
     gemini_opening_for_scenario,
-    get_evaluator_model
+    get_evaluator_model,
+    warm_opener_cache,
+    cached_openers,
+    feedback_context_for_scenario,
 )
 
 # Load environment variables
 load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI")
 
-from TTS import elevenlabs_tts_get_bytes
+from TTS import elevenlabs_tts_get_bytes, SentenceStreamer
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson (C encoder, native datetime support).
+    Anything orjson can't handle (e.g. ObjectId) goes through Flask's default hook.
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 # Flask app
 app = Flask(__name__)
-CORS(app)
+app.json = ORJSONProvider(app)
+# Uploads are a few seconds of speech; anything bigger is rejected before it is read
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_BYTES", str(5 * 1024 * 1024)))
+CORS(app, expose_headers=["X-User-Text", "X-AI-Text", "X-Conversation-Id"])
 
 
 # MongoDB connection
-client = MongoClient(MONGO_URI)
+# zstd needs the zstandard package (pymongo[zstd]); pymongo falls back to zlib without it
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "50")),
+    minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "5")),
+    retryWrites=True,
+    compressors="zstd,zlib",
+)
 db = client["ring_app"]
 users_collection = db["users"]
 conversations_collection = db["conversations"]
+# Turn-log appends are best-effort: acknowledge on the primary only instead of
+# waiting for replica majority on every turn.
+conversation_turns = conversations_collection.with_options(write_concern=WriteConcern(w=1))
+# Turns evicted from the capped in-document tail, one doc per (conv_id, turn)
+conversation_archive = db["conversation_archive"]
+
+# Max turns kept inside a conversation document; older ones move to conversation_archive
+CONVERSATION_TAIL = int(os.getenv("CONVERSATION_TAIL", "40"))
+
+
+def _ensure_indexes():
+    """
+    Idempotent index setup. Failures (e.g. existing duplicate emails) are logged,
+    not fatal, so a bad index never keeps the API from booting.
+    """
+    try:
+        conversations_collection.create_index([("user_id", ASCENDING), ("timestamp", DESCENDING)])
+        # Partial so users created without an email don't collide on null
+        users_collection.create_index(
+            "email",
+            unique=True,
+            partialFilterExpression={"email": {"$type": "string"}},
+        )
+        conversation_archive.create_index([("conv_id", ASCENDING), ("turn", ASCENDING)], unique=True)
+    except PyMongoError as e:
+        print(f"Index creation failed: {e}")
+
+_ensure_indexes()
+
+
+def _append_turn(conv_id: str, turn: dict, answered_turn=None, user_text=None) -> None:
+    """
+    Push a turn onto the conversation, keeping only the last CONVERSATION_TAIL turns
+    in the document so its size (and every read/rewrite of it) stays bounded.
+    Turn numbers are contiguous from 0, so once turn >= CONVERSATION_TAIL the head
+    turn is about to be evicted; it is copied to conversation_archive first.
+
+    If answered_turn is given, user_text is recorded on that turn in the same
+    (pipeline) update, so a user+AI exchange costs one write instead of two.
+
+    The write only applies if no turn with this number exists yet, so a reply
+    generated twice (e.g. a reopened stream on another worker) can't add a duplicate.
+    """
+    oid = ObjectId(conv_id)
+    not_yet_written = {"_id": oid, "conversation.turn": {"$ne": turn["turn"]}}
+    if turn["turn"] >= CONVERSATION_TAIL:
+        head = conversations_collection.find_one({"_id": oid}, {"conversation": {"$slice": 1}})
+        for evicted in (head or {}).get("conversation", []):
+            conversation_archive.update_one(
+                {"conv_id": conv_id, "turn": evicted["turn"]},
+                {"$set": {**evicted, "conv_id": conv_id}},
+                upsert=True,
+            )
+
+    if answered_turn is None:
+        conversation_turns.update_one(
+            not_yet_written,
+            {"$push": {"conversation": {"$each": [turn], "$slice": -CONVERSATION_TAIL}}}
+        )
+        return
+
+    # A positional $set and a $push on the same array conflict in a classic update,
+    # so both are expressed as one aggregation-pipeline $set. $literal keeps user
+    # text like "$5" from being read as a field path.
+    answered = {"$map": {
+        "input": "$conversation",
+        "as": "t",
+        "in": {"$cond": [
+            {"$eq": ["$$t.turn", answered_turn]},
+            {"$mergeObjects": ["$$t", {"user_text": {"$literal": user_text}}]},
+            "$$t",
+        ]},
+    }}
+    conversation_turns.update_one(
+        not_yet_written,
+        [{"$set": {"conversation": {"$slice": [
+            {"$concatArrays": [answered, [{"$literal": turn}]]},
+            -CONVERSATION_TAIL,
+        ]}}}]
+    )
+
+
+def _load_full_conversation(conv_id: str):
+    """
+    Load a conversation with its archived turns stitched back in front of the
+    in-document tail. Returns None if the conversation doesn't exist.
+    """
+    convo = conversations_collection.find_one({"_id": ObjectId(conv_id)})
+    if not convo:
+        return None
+
+    tail = convo.get("conversation", [])
+    if tail and tail[0].get("turn", 0) > 0:
+        archived = conversation_archive.find(
+            {"conv_id": conv_id, "turn": {"$lt": tail[0]["turn"]}},
+            {"_id": 0, "conv_id": 0},
+        ).sort("turn", ASCENDING)
+        convo["conversation"] = list(archived) + tail
+    return convo
 
 
 # Create a user
@@ -62,7 +205,10 @@ def create_user():
         "device_token": data.get("device_token", None),
         "created_at": datetime.now(timezone.utc)  # Changed here
     }
-    res = users_collection.insert_one(user)
+    try:
+        res = users_collection.insert_one(user)
+    except DuplicateKeyError:
+        return jsonify({"error": "email already registered"}), 409
     return jsonify({"user_id": str(res.inserted_id)}), 201
 
 
@@ -79,12 +225,16 @@ def start_call():
         return jsonify({"error": "user_id required"}), 400
 
     # Verify user exists
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    user = users_collection.find_one({"_id": ObjectId(user_id)}, {"_id": 1})
     if not user:
         return jsonify({"error": "invalid user_id"}), 400
 
     scenario_key = find_scenario_key_by_title(scenario_title)
 
+    # The opener doesn't depend on the conversation document, so Gemini (or the
+    # opener pool) works on it while the document is inserted
+    opener = _IO_POOL.submit(gemini_opening_for_scenario, scenario_key)
+
     # Create conversation document
     conv_doc = {
         "user_id": user_id,
@@ -99,34 +249,45 @@ def start_call():
     # -----------------------
     # Always generate first AI line
     # -----------------------
-    # Map title -> canonical scenario key, then ask Gemini for an opener
+    ai_text = opener.result()
 
-    ai_text = gemini_opening_for_scenario(scenario_key)
+    # Save first AI turn; the write runs alongside TTS and is awaited before responding.
+    # Without turn 0 stored the call can't continue, so a failed write is a 500.
+    first_turn = {
+        "turn": 0,
+        "user_text": None,
+        "ai_text": ai_text,
+        "created_at": datetime.now(timezone.utc)
+    }
+    saved = _submit_background(_append_turn, conv_id, first_turn)
+
+    # Clients that accept audio/mpeg get the opener streamed as it is synthesized
+    if _wants_binary_audio():
+        response = _streaming_audio_response(_speak(ai_text), {
+            "X-Conversation-Id": conv_id,
+            "X-AI-Text": _b64_header(ai_text),
+        }, status=201)
+        try:
+            saved.result()
+        except Exception as e:
+            response.close()
+            return jsonify({"error": f"Saving the first turn failed: {str(e)}"}), 500
+        return response
 
-    # Save first AI turn
-    conversations_collection.update_one(
-        {"_id": ObjectId(conv_id)},
-        {"$push": {"conversation": {
-            "turn": 0,
-            "user_text": None,
-            "ai_text": ai_text,
-            "created_at": datetime.now(timezone.utc)
-        }}}
-    )
+    # Generate TTS via ElevenLabs in the background; the client fetches it from the audio URL
+    _stash_audio(conv_id, 0, [
+        _submit_background(elevenlabs_tts_get_bytes, s) for s in iter_sentences([ai_text])
+    ])
 
-    # Placeholder for TTS (ElevenLabs) - return None for now
-        # Generate TTS via ElevenLabs and return base64
     try:
-        ai_audio_bytes = elevenlabs_tts_get_bytes(ai_text)
-        ai_audio_b64 = base64.b64encode(ai_audio_bytes).decode("utf-8")
+        saved.result()
     except Exception as e:
-        print(f"TTS Error: {str(e)}")  # Log the actual error
-        return jsonify({"error": f"TTS generation failed: {str(e)}"}), 500
+        return jsonify({"error": f"Saving the first turn failed: {str(e)}"}), 500
 
     payload = {
         "conversation_id": conv_id,
         "initial_ai_text": ai_text,
-        "initial_ai_audio_b64": ai_audio_b64
+        "initial_ai_audio_url": _audio_url(conv_id, 0)
     }
 
     return jsonify(payload), 201
@@ -137,14 +298,62 @@ ALLOWED_EXTENSIONS = {"m4a", "wav"}
 def _allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Content-Type of a raw audio body -> the extension transcribe_audio_stt expects
+RAW_AUDIO_EXTENSIONS = {
+    "audio/m4a": "m4a",
+    "audio/x-m4a": "m4a",
+    "audio/mp4": "m4a",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/wave": "wav",
+}
+
+def _request_audio():
+    """
+    (conv_id, audio FileStorage) for the audio endpoints.
+    Accepts the multipart form (conv_id + 'audio' file) or a raw audio/* body with
+    conv_id in the query string or X-Conversation-Id header. A raw body skips
+    Werkzeug's multipart parser and its spooled temp file; it is read into memory
+    (MP4/m4a needs a seekable input), bounded by MAX_CONTENT_LENGTH.
+    Aborts with 415 for a raw audio type not in RAW_AUDIO_EXTENSIONS.
+    """
+    if not request.mimetype.startswith("audio/"):
+        return request.form.get("conv_id"), request.files.get("audio")
+
+    ext = RAW_AUDIO_EXTENSIONS.get(request.mimetype)
+    if ext is None:
+        abort(415)
+
+    conv_id = request.args.get("conv_id") or request.headers.get("X-Conversation-Id")
+    body = request.get_data(cache=False)
+    if not body:
+        return conv_id, None
+    return conv_id, FileStorage(
+        stream=BytesIO(body),
+        filename=f"audio.{ext}",
+        content_type=request.mimetype,
+    )
+
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": "Upload too large"}), 413
+
+@app.errorhandler(415)
+def unsupported_audio_type(e):
+    return jsonify({"error": "Unsupported audio type. Send audio/m4a, audio/mp4 or audio/wav."}), 415
+
 # -------------------------------
 # Helper: Transcription of user audio using Google Cloud STT
 # -------------------------------
 def transcribe_audio_stt(audio_file):
     """
     Accepts a werkzeug FileStorage (uploaded 'audio').
-    If .m4a: converts to .wav with convert_m4a_to_wav(), then transcribes with transcribe_wav().
-    If .wav: transcribes directly.
+    If .m4a: decodes it in memory to 16 kHz mono PCM with iter_pcm_chunks() and streams
+    the chunks to transcribe_pcm_stream() while decoding.
+    If .wav: streams its PCM frames straight from the upload via transcribe_wav()
+    (falls back to the PyAV path for non-16-bit WAVs).
+    Nothing is written to disk on either path.
     Returns transcript string.
     """
     if not audio_file or not getattr(audio_file, "filename", ""):
@@ -154,108 +363,66 @@ def transcribe_audio_stt(audio_file):
     if not _allowed_file(filename):
         raise RuntimeError("Unsupported file type. Please upload .m4a or .wav.")
 
-    # Save the uploaded file to a secure temp path
     in_ext = os.path.splitext(filename)[1].lower()  # ".m4a" or ".wav"
-    tmp_in_fd, tmp_in_path = tempfile.mkstemp(suffix=in_ext)
-    os.close(tmp_in_fd)
-    audio_file.save(tmp_in_path)
-
-    wav_path = None
-    try:
-        if in_ext == ".m4a":
-            # Convert to .wav (mono, 16kHz) using your m4atowav.py
-            wav_path = convert_m4a_to_wav(tmp_in_path)
-        else:
-            # Already wav — use the saved path directly
-            wav_path = tmp_in_path
+    if in_ext == ".wav":
+        try:
+            transcript = transcribe_wav(audio_file.stream) or ""
+            return transcript.strip()
+        except wave.Error:
+            audio_file.stream.seek(0)
 
-        # Transcribe using your STT.py
-        transcript = transcribe_wav(wav_path) or ""
-        return transcript.strip()
+    # Decode straight from the upload stream — no temp files, no ffmpeg process
+    transcript = transcribe_pcm_stream(iter_pcm_chunks(audio_file.stream)) or ""
+    return transcript.strip()
 
-    finally:
-        # Cleanup temp files
-        try:
-            if tmp_in_path and os.path.isfile(tmp_in_path):
-                os.remove(tmp_in_path)
-        except Exception:
-            pass
-        if wav_path and wav_path != tmp_in_path:
-            try:
-                if os.path.isfile(wav_path):
-                    os.remove(wav_path)
-            except Exception:
-                pass
+NO_USER_SPEECH = "(no user speech captured)"
 
-def _extract_user_utterances(conversation_doc, max_chars: int = 6000) -> str:
+def _extract_user_utterances(turns, max_chars: int = 6000) -> str:
     """
     Return a single string with only the user's utterances, newest last.
-    Soft-limit total chars to keep prompts reasonable.
+    Soft-limit total chars to keep prompts reasonable: walks turns newest-first and
+    keeps the longest recent run that fits (the newest one is always kept).
     """
-    buf = []
+    kept = deque()
     total = 0
-    for t in conversation_doc.get("conversation", []):
+    for t in reversed(turns):
         ut = (t.get("user_text") or "").strip()
-        if ut:
-            if total + len(ut) > max_chars:
-                # Simple truncation from the start if too long
-                # Keep the most recent parts by popping from the beginning
-                while buf and (total + len(ut) > max_chars):
-                    removed = buf.pop(0)
-                    total -= len(removed)
-            buf.append(ut)
-            total += len(ut)
-    return "\n".join(f"- {u}" for u in buf) if buf else "(no user speech captured)"
+        if not ut:
+            continue
+        if kept and total + len(ut) > max_chars:
+            break
+        kept.appendleft(ut)
+        total += len(ut)
+    return "\n".join(f"- {u}" for u in kept) if kept else NO_USER_SPEECH
 
 
-def _build_feedback_prompt(conv_id: str, scenario_key: str, user_utterances: str) -> str:
+def _build_feedback_prompt(convo: dict, scenario_key: str, user_utterances: str) -> str:
     """
-    ESL tutor-style evaluation prompt.
-    Returns strictly-JSON guidance: CEFR, TOEFL estimate, strengths, issues,
-    concise corrections, and short practice tips.
+    ESL tutor-style evaluation prompt: the rubric, scenario context and the learner's
+    lines. The JSON shape is enforced by the evaluator model's response schema
+    (see get_evaluator_model), so it is not spelled out here.
     """
-    # Retrieve conversation from DB
-    convo = conversations_collection.find_one({"_id": ObjectId(conv_id)})
+    # convo is the already-loaded conversation; it only has to exist
     if not convo:
         raise ValueError("Conversation not found in database.")
-    
-    s = SCENARIOS.get(scenario_key, {})
-    title = s.get("title", scenario_key)
-    setting = s.get("setting", "")
-    stakes = s.get("stakes", "")
-    role = s.get("role", "")
 
     return (
-        "You are an experienced ESL evaluator. Analyze ONLY the learner’s utterances.\n"
-        "STRICTLY with valid JSON, using only the keys below — no prose, no markdown, and no explanations.\n\n"
-        "Your JSON MUST follow this schema exactly:\n"
-        "{\n"
-        '  "success_percentage": int (0-100),\n'
-        '  "grammar_feedback": [\n'
-        '    {"before": "<learner_sentence_with_error>", "after": "<corrected_sentence>"},\n'
-        '    ...\n'
-        "  ] OR null if there are no grammatical issues,\n"
-        '  "grammar_issues": int (number of actual grammar mistakes found, 0 if none),\n'
-        '   "turns": int (number of user utterances analyzed),\n'
-        "}\n\n"
+        "Analyze ONLY the learner’s utterances.\n\n"
         "Rules and guidance:\n"
         "- Only identify grammar or phrasing issues that are clearly incorrect — do not overcorrect - so try to ignore punctuations differences.\n"
         "- DO NOT invent errors. Only include grammar or phrasing errors in the following list: (tense, agreement, prepositions, articles, word order, unnatural phrasing).\n"
         "- If all utterances are grammatically correct and natural, set grammar_feedback to null and grammar_issues to 0.\n"
         "- Use simple, natural English corrections.\n"
-        "- Base your judgment solely on learner utterances — ignore AI lines.\n"
-        "- Return the JSON directly with no text outside the object.\n\n"
-        f"Scenario Context:\n"
-        f"- Title: {title}\n"
-        f"- Setting: {setting}\n"
-        f"- Stakes: {stakes}\n"
-        f"- Roles: {role}\n\n"
+        "- Base your judgment solely on learner utterances — ignore AI lines.\n\n"
+        f"{feedback_context_for_scenario(scenario_key)}"
         f"Learner’s utterances:\n{user_utterances}\n\n"
     )
 
 
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
 def _clean_text(s: str) -> str:
-    return re.sub(r"[^\w\s]", "", s or "").strip().lower()
+    return _PUNCT_RE.sub("", s or "").strip().lower()
 
 @app.route("/process_practice", methods=["POST"])
 def process_practice():
@@ -293,182 +460,825 @@ def process_practice():
 # ------------------------- Gemini AI setup
 # -------------------------
 configure_genai()  # uses GEMINI_API or GEMINI_API_KEY
+
+# Pre-generate scenario openers off the boot path; /start_call falls back to a
+# live Gemini call for any scenario whose pool isn't ready yet.
+# Openers repeat across calls, so their audio is synthesized once up front into the
+# TTS disk cache; /start_call then replays it instead of waiting on ElevenLabs.
+WARM_OPENER_AUDIO = os.getenv("WARM_OPENER_AUDIO", "1") not in ("0", "false", "False")
+
+def _warm_opener_audio():
+    for text in cached_openers():
+        # Same segmentation as _speak, so these are exactly the entries /start_call reads
+        for sentence in iter_sentences([text]):
+            try:
+                elevenlabs_tts_get_bytes(sentence)
+            except Exception as e:
+                print(f"Opener audio warmup stopped: {e}")
+                return
+
+# Audio warmup runs inside the opener warmup lock, so only one worker synthesizes;
+# the others then hit the shared TTS disk cache
+threading.Thread(
+    target=warm_opener_cache,
+    kwargs={"then": _warm_opener_audio if WARM_OPENER_AUDIO else None},
+    daemon=True,
+).start()
     
-def generate_ai_text(conversation_context: str, scenario_key: str = "General") -> str:
+FALLBACK_AI_TEXT = "I couldn’t quite hear that. Could you say it again, briefly?"
+
+def _chunk_text(chunk) -> str:
+    # .text raises on chunks without text parts (e.g. the final safety/finish chunk)
+    try:
+        return chunk.text or ""
+    except Exception:
+        return ""
+
+def generate_ai_sentences(chat, message: str, errors=None):
     """
-    Generates the next AI reply from Gemini using a single string prompt.
-    This keeps compatibility with your current /process_audio call.
+    Sends `message` on a Gemini chat session and streams the reply back,
+    yielding it one sentence at a time as soon as each sentence is complete.
+    On failure (even mid-stream) an error line is yielded and, if `errors` is a
+    list, the exception is appended to it so callers can tell a partial reply apart.
     """
     try:
-        model = get_model_for_scenario(scenario_key)
-        chat = model.start_chat()
-        resp = chat.send_message(conversation_context or "...")
-        ai_text = (getattr(resp, "text", "") or "").strip()
-        if not ai_text:
-            ai_text = "I couldn’t quite hear that. Could you say it again, briefly?"
-        return ai_text
+        resp = chat.send_message(message or "...", stream=True)
+        produced = False
+        for sentence in iter_sentences(_chunk_text(c) for c in resp):
+            produced = True
+            yield sentence
+        if not produced:
+            yield FALLBACK_AI_TEXT
     except Exception as e:
         # Don't crash your request path if Gemini misconfigures
-        return f"(Gemini error: {e})"
+        if errors is not None:
+            errors.append(e)
+        yield f"(Gemini error: {e})"
+
+# -------------------------------
+# Gemini chat sessions
+# -------------------------------
+# A session is built per turn from the recent turns already loaded from Mongo,
+# so any worker can answer any turn and nothing is kept between requests.
+CALL_START_CUE = "Start the call."
+
+def _history_from_turns(turns) -> list:
+    """
+    Gemini chat history for stored turns (ai_text -> model, user_text -> user).
+    Opens with a user cue (history must not start with the model) and merges
+    consecutive same-role lines so roles always alternate.
+    """
+    messages = [("user", CALL_START_CUE)]
+    for t in turns:
+        for role, text in (("model", t.get("ai_text")), ("user", t.get("user_text"))):
+            text = (text or "").strip()
+            if not text:
+                continue
+            if messages[-1][0] == role:
+                messages[-1] = (role, f"{messages[-1][1]}\n{text}")
+            else:
+                messages.append((role, text))
+    return [{"role": role, "parts": [text]} for role, text in messages]
+
+def _chat_for_turns(scenario_key: str, turns, message: str):
+    """Start a chat session holding `turns` and return (chat, message_to_send)."""
+    history = _history_from_turns(turns)
+    if history[-1]["role"] == "user":
+        # Turn order went wrong upstream; fold the dangling user line into this message
+        message = f"{history.pop()['parts'][0]}\n{message}"
+    return get_model_for_scenario(scenario_key).start_chat(history=history), message
+
+# -------------------------------
+# Background I/O
+# -------------------------------
+# Mongo writes and per-sentence TTS calls run here so they overlap with the
+# next network-bound step instead of adding to the request's wall time.
+_IO_POOL = ThreadPoolExecutor(max_workers=16)
+
+def _log_failure(future):
+    e = future.exception()
+    if e is not None:
+        print(f"Background task failed: {e}")
+
+def _submit_background(fn, *args, **kwargs):
+    """Fire-and-forget a call on the I/O pool, logging (not raising) any error."""
+    future = _IO_POOL.submit(fn, *args, **kwargs)
+    future.add_done_callback(_log_failure)
+    return future
+
+def _await_write(future) -> None:
+    """Wait for a _submit_background write; a failure was already logged, so it isn't raised."""
+    try:
+        future.result()
+    except Exception:
+        pass
 
 # -------------------------------
 # Endpoint: process user audio
 # -------------------------------
 
-@app.route("/process_audio", methods=["POST"])
-def process_audio():
-    # Get form data
-    conv_id = request.form.get("conv_id")
-    audio_file = request.files.get("audio")
+# How many recent turns are read from Mongo each turn; they are also the history
+# the turn's Gemini chat session is started with.
+CONTEXT_TURNS = int(os.getenv("CONTEXT_TURNS", "10"))
 
-    if not conv_id or not audio_file:
-        return jsonify({"error": "conv_id and audio file are required"}), 400
+class TurnResult(NamedTuple):
+    user_text: str
+    ai_text: str
+    turn: int        # number of the new AI turn
+    saved: Future    # completes once the AI turn is written to Mongo
 
-    # Verify conversation exists
-    conversation = conversations_collection.find_one({"_id": ObjectId(conv_id)})
-    if not conversation:
-        return jsonify({"error": "Invalid conversation ID"}), 400
+
+def _transcribe_with_context(conv_id: str, audio_file):
+    """
+    Transcribe the user's audio and load the conversation's recent turns alongside it.
+    Returns (user_text, conversation). Raises LookupError if the conversation does not exist.
+    """
+    # Load the recent turns (the chat session's history) while STT runs on this thread
+    conversation_future = _IO_POOL.submit(
+        conversations_collection.find_one,
+        {"_id": ObjectId(conv_id)},
+        {"scenario": 1, "conversation": {"$slice": -CONTEXT_TURNS}},
+    )
 
     #Transcribe audio using speech to text
     user_response = transcribe_audio_stt(audio_file)
 
+    # Verify conversation exists
+    conversation = conversation_future.result()
+    if not conversation:
+        raise LookupError("Invalid conversation ID")
+    return user_response, conversation
+
+
+def _reply_to_turn(conv_id: str, conversation: dict, user_response: str, on_sentence=None) -> TurnResult:
+    """
+    Asks Gemini for the next line after the user's reply to the last loaded turn and
+    pushes it as a new AI turn (in the background), recording the reply on the
+    answered turn in the same write.
+    on_sentence(sentence) is called for each reply sentence as Gemini produces it,
+    so callers can start TTS before the full reply exists.
+    """
     # Fetch the previous turn
     last_turn = conversation["conversation"][-1]
+    scenario_key = conversation.get("scenario", "General")
+
+    # Build the Gemini session from the loaded turns; it ends on the AI line the user is answering
+    chat, message = _chat_for_turns(scenario_key, conversation["conversation"], user_response)
     
     
+    answered_turn = None
     if last_turn["ai_text"] and last_turn["user_text"] is None:
         #We know here that nothing wrong has happened with the AI/User turn order...
-        conversations_collection.update_one(
-            {"_id": ObjectId(conv_id), "conversation.turn": last_turn["turn"]},
-            {"$set": {"conversation.$.user_text": user_response}}
-        )
+        # Written together with the AI turn below
+        answered_turn = last_turn["turn"]
     else:
         #Something has gone wrong with the User/AI turn order
         #The most recent turn does not have format AI:'sampletext', User_text:None
-        print("User/AI turn order has gone wrong. Check line 170, app.py")
+        print("User/AI turn order has gone wrong. Check _run_conversation_turn, app.py")
         
     
 
-    #Fetch the updated conversation
-    conversation = conversations_collection.find_one({"_id": ObjectId(conv_id)})
+    # Near-duplicate replies to the same AI line reuse an earlier reply (and its TTS)
+    ai_line = last_turn.get("ai_text") or ""
+    cached_sentences, query_vec = semantic_cache.lookup(scenario_key, ai_line, user_response)
+
+    # Generate AI response, handing each sentence off as soon as it is complete.
+    # The session holds the recent history, so only the new user line is added here.
+    sentences = []
+    gemini_errors = []
+    for sentence in cached_sentences or generate_ai_sentences(chat, message, gemini_errors):
+        sentences.append(sentence)
+        if on_sentence:
+            on_sentence(sentence)
+    ai_text = " ".join(sentences)
+
+    if cached_sentences is None and not gemini_errors:
+        # Embedding the reply (if lookup didn't) happens off the reply path
+        _submit_background(semantic_cache.store, scenario_key, ai_line, user_response, sentences, query_vec)
+
+    # Create a new AI-only turn; the user's reply is recorded in the same background write
+    new_turn_number = last_turn["turn"] + 1
+    saved = _submit_background(_append_turn, conv_id, {
+        "turn": new_turn_number,
+        "user_text": None,
+        "ai_text": ai_text,
+        "created_at": datetime.now(timezone.utc)
+    }, answered_turn=answered_turn, user_text=user_response)
+
+    return TurnResult(user_response, ai_text, new_turn_number, saved)
 
-    # Build conversation context (including the full history)
-    context_text = ""
-    for turn_data in conversation.get("conversation", []):
-        ai_text = turn_data.get("ai_text")
-        user_text = turn_data.get("user_text")
 
-        if ai_text and ai_text.strip():
-            context_text += f"AI: {ai_text}\n"
+def _run_conversation_turn(conv_id: str, audio_file, on_sentence=None) -> TurnResult:
+    """
+    Shared body of /process_audio and /process_audio_stream: transcribe, then reply.
+    Raises LookupError if the conversation does not exist.
+    """
+    user_response, conversation = _transcribe_with_context(conv_id, audio_file)
+    return _reply_to_turn(conv_id, conversation, user_response, on_sentence)
 
-        if user_text and user_text.strip():
-            context_text += f"User: {user_text}\n"
 
-    # Generate AI response (placeholder)
-    ai_text = generate_ai_text(context_text, scenario_key=conversation.get("scenario", "General"))
+def _b64_header(text: str) -> str:
+    """HTTP headers are latin-1 only, so transcripts travel base64-encoded UTF-8."""
+    return base64.b64encode((text or "").encode("utf-8")).decode("ascii")
 
-    # Create a new AI-only turn
-    new_turn_number = last_turn["turn"] + 1
-    conversations_collection.update_one(
-        {"_id": ObjectId(conv_id)},
-        {"$push": {"conversation": {
-            "turn": new_turn_number,
-            "user_text": None,
+
+def _wants_binary_audio() -> bool:
+    """True when the client asked for audio/mpeg over the default JSON payload."""
+    return request.accept_mimetypes.best_match(["application/json", "audio/mpeg"]) == "audio/mpeg"
+
+
+def _audio_url(conv_id: str, turn: int) -> str:
+    return url_for("tts_stream", conv_id=conv_id, turn=turn)
+
+
+# -------------------------------
+# Synthesized audio for recently answered turns
+# -------------------------------
+# JSON responses carry an audio URL instead of base64 audio. The TTS futures for
+# the turn are kept here (per worker) so GET /tts_stream/<conv_id>?turn=N can hand back
+# the bytes as soon as they are ready; anything not found here (expired, other
+# worker) is re-synthesized from the stored turn, which mostly hits the TTS cache.
+AUDIO_TTL_S = int(os.getenv("AUDIO_TTL_S", "300"))
+_pending_audio = {}  # "conv_id:turn" -> (expires_at, [Future[bytes], ...])
+_pending_audio_lock = threading.Lock()
+
+def _stash_audio(conv_id: str, turn: int, futures) -> None:
+    now = time.monotonic()
+    with _pending_audio_lock:
+        for key in [k for k, (expires_at, _) in _pending_audio.items() if expires_at <= now]:
+            del _pending_audio[key]
+        _pending_audio[f"{conv_id}:{turn}"] = (now + AUDIO_TTL_S, futures)
+
+def _stashed_audio(conv_id: str, turn: int):
+    with _pending_audio_lock:
+        entry = _pending_audio.get(f"{conv_id}:{turn}")
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    return entry[1]
+
+
+def _speak(ai_text: str) -> SentenceStreamer:
+    """
+    A closed SentenceStreamer for an already-complete line. Uses the same sentence
+    segmentation as the live pipeline so replays hit the per-sentence TTS cache.
+    """
+    streamer = SentenceStreamer()
+    for sentence in iter_sentences([ai_text]):
+        streamer.feed(sentence)
+    streamer.close()
+    return streamer
+
+
+def _streaming_audio_response(streamer: SentenceStreamer, headers: dict, status: int = 200):
+    """
+    Stream a closed SentenceStreamer back as audio/mpeg. The first chunk is pulled
+    eagerly so TTS failures still surface as a JSON 500 instead of a truncated body.
+    """
+    audio_stream = streamer.chunks()
+    try:
+        first_chunk = next(audio_stream, b"")
+    except Exception as e:
+        print(f"TTS Error: {str(e)}")  # Log the actual error
+        return jsonify({"error": f"TTS generation failed: {str(e)}"}), 500
+
+    def generate():
+        yield first_chunk
+        yield from audio_stream
+
+    return Response(stream_with_context(generate()), mimetype="audio/mpeg", headers=headers), status
+
+
+@app.route("/process_audio", methods=["POST"])
+def process_audio():
+    """
+    Responds with JSON (transcripts + ai_audio_url) by default; the audio keeps
+    synthesizing in the background and is fetched from the URL. Clients that send
+    `Accept: audio/mpeg` get the raw mp3 as the body instead, with the transcripts
+    in X-User-Text / X-AI-Text headers.
+    """
+    # Get form data
+    conv_id, audio_file = _request_audio()
+
+    if not conv_id or not audio_file:
+        return jsonify({"error": "conv_id and audio file are required"}), 400
+
+    # Each sentence is synthesized in parallel while Gemini is still writing the next one
+    tts_futures = []
+    try:
+        result = _run_conversation_turn(
+            conv_id, audio_file,
+            on_sentence=lambda s: tts_futures.append(_IO_POOL.submit(elevenlabs_tts_get_bytes, s)),
+        )
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 400
+    user_response, ai_text = result.user_text, result.ai_text
+
+    if not _wants_binary_audio():
+        _stash_audio(conv_id, result.turn, tts_futures)
+
+        # A fallback fetch of the audio URL reads the turn back from Mongo, so make
+        # sure it has landed (the write ran alongside Gemini, so this rarely waits)
+        _await_write(result.saved)
+
+        return jsonify({
+            "user_text": user_response,
             "ai_text": ai_text,
-            "created_at": datetime.now(timezone.utc)
-        }}}
+            "ai_audio_url": _audio_url(conv_id, result.turn)
+        }), 200
+
+    # Generate TTS via ElevenLabs
+    try:
+        ai_audio_bytes = b"".join(f.result() for f in tts_futures)
+    except Exception as e:
+        print(f"TTS Error: {str(e)}")  # Log the actual error
+        return jsonify({"error": f"TTS generation failed: {str(e)}"}), 500
+
+    return Response(
+        ai_audio_bytes,
+        mimetype="audio/mpeg",
+        headers={
+            "X-User-Text": _b64_header(user_response),
+            "X-AI-Text": _b64_header(ai_text),
+        },
+    ), 200
+
+
+@app.route("/process_audio_stream", methods=["POST"])
+def process_audio_stream():
+    """
+    Same contract as /process_audio, but the AI reply is streamed back as raw audio/mpeg
+    while ElevenLabs is still synthesizing it. The transcripts travel in the
+    X-User-Text / X-AI-Text headers (base64-encoded UTF-8).
+    """
+    conv_id, audio_file = _request_audio()
+
+    if not conv_id or not audio_file:
+        return jsonify({"error": "conv_id and audio file are required"}), 400
+
+    # TTS of the first sentence starts while Gemini is still generating the rest
+    streamer = SentenceStreamer()
+    try:
+        result = _run_conversation_turn(conv_id, audio_file, on_sentence=streamer.feed)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        streamer.close()
+
+    return _streaming_audio_response(streamer, {
+        "X-User-Text": _b64_header(result.user_text),
+        "X-AI-Text": _b64_header(result.ai_text),
+    })
+
+
+def _stream_turn_audio(conv_id: str, turn=None):
+    """Synthesize (or replay from the TTS cache) the stored text of one AI turn."""
+    conversation = conversations_collection.find_one(
+        {"_id": ObjectId(conv_id)},
+        {"conversation": {"$slice": -CONVERSATION_TAIL}},
     )
+    if not conversation:
+        return jsonify({"error": "Invalid conversation ID"}), 400
+
+    turns = conversation.get("conversation", [])
+    if turn is not None:
+        turns = [t for t in turns if t.get("turn") == turn]
+    if not turns or not turns[-1].get("ai_text"):
+        return jsonify({"error": "turn not found"}), 404
+
+    return _streaming_audio_response(_speak(turns[-1]["ai_text"]), {})
+
+
+@app.route("/tts_stream/<conv_id>", methods=["GET"])
+def tts_stream(conv_id):
+    """
+    The mp3 for one AI turn (?turn=N, default: the latest), as referenced by the
+    audio URLs in JSON responses. Served from the background synthesis started by
+    that response when this worker still has it, otherwise streamed from the
+    stored turn text as it is synthesized.
+    """
+    turn = request.args.get("turn", type=int)
+    futures = _stashed_audio(conv_id, turn) if turn is not None else None
+    if futures is None:
+        return _stream_turn_audio(conv_id, turn)
 
-    # Generate TTS via ElevenLabs and return base64
     try:
-        ai_audio_bytes = elevenlabs_tts_get_bytes(ai_text)
-        ai_audio_b64 = base64.b64encode(ai_audio_bytes).decode("utf-8")
+        audio = b"".join(f.result() for f in futures)
     except Exception as e:
         print(f"TTS Error: {str(e)}")  # Log the actual error
         return jsonify({"error": f"TTS generation failed: {str(e)}"}), 500
-        
 
-    # Return response to frontend
+    return send_file(BytesIO(audio), mimetype="audio/mpeg")
+
+
+# -------------------------------
+# Two-step turns: transcript first, reply over SSE
+# -------------------------------
+# POST /submit_audio answers as soon as STT is done; the client then opens
+# GET /stream/<turn_id> and receives the reply text and audio as they are produced.
+# turn_id is "<conv_id>-<number of the AI turn being generated>".
+
+# A stream claims its turn in Mongo (generating_turn) before asking Gemini, so a
+# reopened stream on any worker waits for the stored reply instead of generating
+# a second one. A claim older than GENERATION_STALE_AFTER_S is taken over.
+GENERATION_STALE_AFTER_S = int(os.getenv("GENERATION_STALE_AFTER_S", "60"))
+GENERATION_POLL_S = 0.25
+
+def _sse(event: str, data) -> str:
+    payload = data if isinstance(data, str) else orjson.dumps(data).decode("utf-8")
+    return f"event: {event}\ndata: {payload}\n\n"
+
+def _sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _claim_turn(conv_id: str, turn: int) -> bool:
+    """True if this request may generate AI turn `turn` (it isn't stored or claimed yet)."""
+    now = datetime.now(timezone.utc)
+    claimed = conversations_collection.update_one(
+        {
+            "_id": ObjectId(conv_id),
+            "conversation.turn": {"$ne": turn},
+            "$or": [
+                {"generating_turn": {"$ne": turn}},
+                {"generating_started_at": {"$lt": now - timedelta(seconds=GENERATION_STALE_AFTER_S)}},
+            ],
+        },
+        {"$set": {"generating_turn": turn, "generating_started_at": now}},
+    )
+    return claimed.modified_count == 1
+
+def _release_turn(conv_id: str, turn: int) -> None:
+    """Drop a claim whose generation failed, so the next reopened stream can retry right away."""
+    conversations_collection.update_one(
+        {"_id": ObjectId(conv_id), "generating_turn": turn},
+        {"$unset": {"generating_turn": "", "generating_started_at": ""}},
+    )
+
+def _replay_events(ai_text: str, turn: int):
+    """SSE events for a reply that is already stored; audio mostly comes from the TTS cache."""
+    for sentence in iter_sentences([ai_text]):
+        yield _sse("text", {"text": sentence})
+    try:
+        for chunk in _speak(ai_text).chunks():
+            yield _sse("audio", base64.b64encode(chunk).decode("ascii"))
+    except Exception as e:
+        print(f"TTS Error: {str(e)}")  # Log the actual error
+        yield _sse("error", {"error": f"TTS generation failed: {str(e)}"})
+        return
+    yield _sse("done", {"ai_text": ai_text, "turn": turn})
+
+def _stored_reply_events(conv_id: str, turn: int):
+    """SSE events for a turn another request claimed: wait until its reply is stored, then replay it."""
+    deadline = time.monotonic() + GENERATION_STALE_AFTER_S
+    while time.monotonic() < deadline:
+        convo = conversations_collection.find_one(
+            {"_id": ObjectId(conv_id)},
+            {"conversation": {"$elemMatch": {"turn": turn}}},
+        )
+        stored = (convo or {}).get("conversation")
+        if stored:
+            yield from _replay_events(stored[0].get("ai_text") or "", turn)
+            return
+        time.sleep(GENERATION_POLL_S)
+    yield _sse("error", {"error": "Reply generation timed out; reopen the stream to retry"})
+
+def _reply_events(conv_id: str, conversation: dict):
+    """
+    Generate the reply on the I/O pool and interleave its sentences (event: text)
+    with the synthesized audio (event: audio) on a single queue, in arrival order.
+    The caller must hold the turn's claim (_claim_turn).
+    """
+    last_turn = conversation["conversation"][-1]
+    user_response = last_turn["user_text"]
+    # Already stored by /submit_audio; cleared locally so the turn reads as the one being answered
+    last_turn["user_text"] = None
+
+    events = queue.Queue()
+    streamer = SentenceStreamer()
+
+    def on_sentence(sentence):
+        events.put(_sse("text", {"text": sentence}))
+        streamer.feed(sentence)
+
+    def generate_reply():
+        try:
+            return _reply_to_turn(conv_id, conversation, user_response, on_sentence)
+        except Exception:
+            _release_turn(conv_id, last_turn["turn"] + 1)
+            raise
+        finally:
+            streamer.close()
+
+    def drain_audio():
+        try:
+            for chunk in streamer.chunks():
+                events.put(_sse("audio", base64.b64encode(chunk).decode("ascii")))
+        except Exception as e:
+            print(f"TTS Error: {str(e)}")  # Log the actual error
+            events.put(_sse("error", {"error": f"TTS generation failed: {str(e)}"}))
+        finally:
+            events.put(None)
+
+    reply = _IO_POOL.submit(generate_reply)
+    threading.Thread(target=drain_audio, daemon=True).start()
+
+    def stream():
+        while True:
+            item = events.get()
+            if item is None:
+                break
+            yield item
+        try:
+            result = reply.result()
+        except Exception as e:
+            print(f"Reply generation failed: {e}")
+            yield _sse("error", {"error": f"Reply generation failed: {str(e)}"})
+            return
+        yield _sse("done", {"ai_text": result.ai_text, "turn": result.turn})
+
+    return stream()
+
+
+@app.route("/submit_audio", methods=["POST"])
+def submit_audio():
+    """
+    First half of a two-step turn. Transcribes the user's audio, records it on the
+    pending AI turn and returns {user_text, turn_id, stream_url} right away; the
+    reply is generated once the client opens the stream URL.
+    """
+    conv_id, audio_file = _request_audio()
+
+    if not conv_id or not audio_file:
+        return jsonify({"error": "conv_id and audio file are required"}), 400
+
+    try:
+        user_response, conversation = _transcribe_with_context(conv_id, audio_file)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # The stream reads the reply back from Mongo (possibly on another worker), so
+    # this write is acknowledged before the turn_id is handed out
+    last_turn = conversation["conversation"][-1]
+    conversation_turns.update_one(
+        {"_id": ObjectId(conv_id), "conversation.turn": last_turn["turn"]},
+        {"$set": {"conversation.$.user_text": user_response}},
+    )
+
+    turn_id = f"{conv_id}-{last_turn['turn'] + 1}"
     return jsonify({
         "user_text": user_response,
-        "ai_text": ai_text,
-        "ai_audio_b64": ai_audio_b64
+        "turn_id": turn_id,
+        "stream_url": url_for("stream_turn", turn_id=turn_id),
     }), 200
 
+
+@app.route("/stream/<turn_id>", methods=["GET"])
+def stream_turn(turn_id):
+    """
+    Second half of a two-step turn, as text/event-stream:
+      event: text   {"text": sentence}       each reply sentence as Gemini finishes it
+      event: audio  base64 mp3 chunk         as ElevenLabs synthesizes it
+      event: done   {"ai_text": ..., "turn": N}
+      event: error  {"error": ...}
+    Safe to reopen: a reply that is already stored is replayed, not regenerated.
+    """
+    conv_id, _, turn = turn_id.rpartition("-")
+    if not conv_id or not turn.isdigit():
+        return jsonify({"error": "invalid turn_id"}), 400
+    turn = int(turn)
+
+    conversation = conversations_collection.find_one(
+        {"_id": ObjectId(conv_id)},
+        {"scenario": 1, "conversation": {"$slice": -CONTEXT_TURNS}},
+    )
+    if not conversation:
+        return jsonify({"error": "Invalid conversation ID"}), 400
+
+    turns = conversation.get("conversation", [])
+    stored = next((t for t in turns if t.get("turn") == turn), None)
+    if stored is not None:
+        return _sse_response(_replay_events(stored.get("ai_text") or "", turn))
+
+    # Only the turn right after the answered one can be generated
+    if not turns or turns[-1].get("turn") != turn - 1 or turns[-1].get("user_text") is None:
+        return jsonify({"error": "turn not found"}), 404
+
+    # Another request (on any worker) is generating this turn: replay it once stored
+    if not _claim_turn(conv_id, turn):
+        return _sse_response(_stored_reply_events(conv_id, turn))
+    return _sse_response(_reply_events(conv_id, conversation))
+
 from datetime import datetime
 
 
-#End call endpoint to send conversation
-@app.route("/end_call", methods=["POST"])
-def end_call():
-    conv_id = request.form.get("conv_id") or (request.json or {}).get("conv_id")
-    if not conv_id:
-        return jsonify({"error": "conv_id is required"}), 400
+def _merge_feedback(previous: dict, latest: dict) -> dict:
+    """
+    Combine feedback for earlier turns with feedback for the turns evaluated since:
+    corrections are concatenated, counts summed, and the score weighted by turns.
+    """
+    merged = dict(latest)
+    pairs = [p for fb in (previous, latest) for p in (fb.get("grammar_feedback") or []) if isinstance(p, dict)]
+    merged["grammar_feedback"] = pairs or None
 
-    # 1) Load conversation
-    convo = conversations_collection.find_one({"_id": ObjectId(conv_id)})
-    if not convo:
-        return jsonify({"error": "Invalid conversation ID"}), 400
+    def count(fb, key):
+        value = fb.get(key)
+        return value if isinstance(value, int) else 0
 
-    scenario_key = convo.get("scenario", "General")
+    merged["grammar_issues"] = count(previous, "grammar_issues") + count(latest, "grammar_issues")
+    prev_turns, new_turns = count(previous, "turns"), count(latest, "turns")
+    merged["turns"] = prev_turns + new_turns
+    prev_score, new_score = previous.get("success_percentage"), latest.get("success_percentage")
+    if isinstance(prev_score, (int, float)) and isinstance(new_score, (int, float)) and prev_turns + new_turns:
+        merged["success_percentage"] = round((prev_score * prev_turns + new_score * new_turns) / (prev_turns + new_turns))
+    return merged
 
-    # 2) Build feedback prompt (scenario + only user lines)
-    user_utterances = _extract_user_utterances(convo)
-    prompt = _build_feedback_prompt(conv_id, scenario_key, user_utterances)
 
-    # 3) Ask Gemini for JSON feedback using the SCENARIO model
-    try:
-        model = get_evaluator_model()
-        resp = model.generate_content(prompt)
-        feedback_text = (getattr(resp, "text", "") or "").strip()
-    except Exception as e:
-        # If Gemini fails, store a friendly error
-        feedback_text = json.dumps({
-            "error": "feedback_generation_failed",
-            "detail": str(e)[:300]
-        })
+def _evaluate_conversation(conv_id: str, convo: dict) -> dict:
+    """
+    Ask the evaluator for grammar feedback on the learner's lines and store it on the
+    conversation (grammar_feedback + feedback_ready). Returns the stored feedback,
+    always a dict: malformed model output is kept as {"raw": ...}.
 
-    # 4) Try to parse JSON to ensure it’s valid; if not, wrap it
-    try:
-        parsed = json.loads(feedback_text)
-        grammar_feedback = parsed
-    except Exception:
-        # Model didn’t return pure JSON; store raw text for debugging
-        grammar_feedback = {"raw": feedback_text}
+    Only turns after last_eval_turn are sent; their feedback is merged into the
+    stored result, so re-evaluating a call (or grading it mid-call) never pays for
+    the same utterances twice.
+    """
+    scenario_key = convo.get("scenario", "General")
+    turns = convo.get("conversation", [])
+    last_eval_turn = convo.get("last_eval_turn", -1)
+    previous = convo.get("grammar_feedback")
+    if last_eval_turn < 0 or not isinstance(previous, dict) or "raw" in previous or "error" in previous:
+        last_eval_turn, previous = -1, None
+    update = {}
+
+    # 1) Build feedback prompt (scenario + only user lines not evaluated yet)
+    user_utterances = _extract_user_utterances([t for t in turns if t.get("turn", 0) > last_eval_turn])
+    if user_utterances == NO_USER_SPEECH:
+        # Nothing new to evaluate; skip the evaluator round-trip entirely
+        grammar_feedback = previous or {"grammar_feedback": [], "success_percentage": 0}
+    else:
+        prompt = _build_feedback_prompt(convo, scenario_key, user_utterances)
 
-    # OPTIONAL: Save feedback back into the conversation
+        # 2) Ask Gemini for JSON feedback using the evaluator model
+        try:
+            model = get_evaluator_model()
+            resp = model.generate_content(prompt)
+            feedback_text = (getattr(resp, "text", "") or "").strip()
+        except Exception as e:
+            # If Gemini fails, store a friendly error
+            feedback_text = orjson.dumps({
+                "error": "feedback_generation_failed",
+                "detail": str(e)[:300]
+            }).decode("utf-8")
+
+        # 3) Try to parse JSON to ensure it’s a JSON object; if not, wrap it
+        try:
+            grammar_feedback = orjson.loads(feedback_text)
+        except Exception:
+            grammar_feedback = None
+        if not isinstance(grammar_feedback, dict):
+            # Model didn’t return a JSON object; store raw text for debugging
+            grammar_feedback = {"raw": feedback_text}
+
+        if "raw" not in grammar_feedback and "error" not in grammar_feedback:
+            if previous:
+                grammar_feedback = _merge_feedback(previous, grammar_feedback)
+            # Failed evaluations leave last_eval_turn alone so a retry covers the same turns
+            if turns:
+                update["last_eval_turn"] = turns[-1].get("turn", 0)
+
+    # 4) Save feedback back into the conversation; /feedback/<conv_id> serves it from here
     conversations_collection.update_one(
         {"_id": ObjectId(conv_id)},
-        {"$set": {"grammar_feedback": grammar_feedback}}
+        {"$set": {"grammar_feedback": grammar_feedback, "feedback_ready": True, **update}}
     )
+    return grammar_feedback
 
-    # Only keep the conversation array, not metadata
-    # Only keep the conversation array, not metadata
-    conversation_array = convo.get("conversation", [])
 
+def _feedback_payload(grammar_feedback: dict) -> dict:
+    """Client-facing view of stored feedback: filtered corrections and the score."""
     # Safely get pairs from the model output
-    pairs = []
-    if isinstance(grammar_feedback, dict):
-        pairs = grammar_feedback.get("grammar_feedback") or grammar_feedback.get("corrections") or []
-        if not isinstance(pairs, list):
-            pairs = []
+    pairs = grammar_feedback.get("grammar_feedback") or grammar_feedback.get("corrections") or []
+    if not isinstance(pairs, list):
+        pairs = []
 
     # FILTER: keep only real differences beyond spacing/punctuation/case
     filtered_pairs = []
     for p in pairs:
-        before = (p.get("before") or "").strip()
-        after  = (p.get("after")  or "").strip()
+        if not isinstance(p, dict):
+            continue
+        before = str(p.get("before") or "").strip()
+        after  = str(p.get("after")  or "").strip()
         if before and after and _clean_text(before) != _clean_text(after):
             filtered_pairs.append({"before": before, "after": after})
 
-    return jsonify({
+    return {
+        "grammarErrors": [{"error": i["before"], "correction": i["after"]} for i in filtered_pairs],
+        "score": grammar_feedback.get("success_percentage"),
+        "encouragement": "filler"
+    }
+
+
+# Evaluations are multi-second Gemini calls; they get their own pool so they never
+# queue ahead of per-sentence TTS and turn writes on _IO_POOL.
+_EVAL_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("EVAL_WORKERS", "4")))
+# A pending evaluation older than this is assumed lost (e.g. its worker died) and
+# is re-queued by the next /feedback poll
+EVAL_STUCK_AFTER_S = int(os.getenv("EVAL_STUCK_AFTER_S", "120"))
+
+def _queue_evaluation(conv_id: str, convo: dict):
+    future = _EVAL_POOL.submit(_evaluate_conversation, conv_id, convo)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+#End call endpoint to send conversation
+@app.route("/end_call", methods=["POST"])
+def end_call():
+    """
+    Returns the transcripts right away and evaluates the call in the background:
+    {status: "pending", feedback_url, ...}; poll feedback_url for the result.
+    Send wait=true to block until the feedback is ready and get it inline.
+    """
+    body = request.json if request.is_json else {}
+    conv_id = request.form.get("conv_id") or (body or {}).get("conv_id")
+    if not conv_id:
+        return jsonify({"error": "conv_id is required"}), 400
+    wait = str(request.form.get("wait") or (body or {}).get("wait") or "").lower() in ("1", "true")
+
+    # Load conversation (including turns moved to the archive)
+    convo = _load_full_conversation(conv_id)
+    if not convo:
+        return jsonify({"error": "Invalid conversation ID"}), 400
+
+    # Mark as pending before the evaluation can finish, so a fast result isn't overwritten
+    conversations_collection.update_one(
+        {"_id": ObjectId(conv_id)},
+        {"$set": {"feedback_ready": False, "feedback_started_at": datetime.now(timezone.utc)}}
+    )
+    evaluation = _queue_evaluation(conv_id, convo)
+
+    # Only keep the conversation array, not metadata
+    conversation_array = convo.get("conversation", [])
+    payload = {
         "scenario": "test",
         "userTranscript": [i.get("user_text") for i in conversation_array],
         "aiTranscript": [i.get("ai_text") for i in conversation_array],
-        "grammarErrors": [{"error": i["before"], "correction": i["after"]} for i in filtered_pairs],
-        "score": grammar_feedback.get("success_percentage") if isinstance(grammar_feedback, dict) else None,
-        "encouragement": "filler"
-    }), 200
+        "status": "pending",
+        "feedback_url": url_for("get_feedback", conv_id=conv_id),
+    }
+
+    if not wait:
+        return jsonify(payload), 202
+
+    try:
+        grammar_feedback = evaluation.result()
+    except Exception as e:
+        return jsonify({"error": f"Feedback generation failed: {str(e)}"}), 500
+    payload.update(_feedback_payload(grammar_feedback), status="ready")
+    return jsonify(payload), 200
+
+
+@app.route("/feedback/<conv_id>", methods=["GET"])
+def get_feedback(conv_id):
+    """
+    Feedback for a call ended via /end_call: 202 {status: "pending"} until it is ready,
+    404 if the call was never sent for evaluation.
+    An evaluation pending for longer than EVAL_STUCK_AFTER_S is re-queued.
+    """
+    oid = ObjectId(conv_id)
+    convo = conversations_collection.find_one(
+        oid,
+        {"grammar_feedback": 1, "feedback_ready": 1, "feedback_started_at": 1},
+    )
+    if not convo:
+        return jsonify({"error": "Invalid conversation ID"}), 400
+    if "feedback_ready" not in convo:
+        # Evaluated before feedback_ready existed (ready), or never sent to /end_call
+        if convo.get("grammar_feedback") is None:
+            return jsonify({"error": "No evaluation for this call; end it with /end_call first"}), 404
+    elif not convo["feedback_ready"]:
+        started_at = convo.get("feedback_started_at")
+        now = datetime.now(timezone.utc)
+        if started_at is None or (now - started_at.replace(tzinfo=timezone.utc)).total_seconds() > EVAL_STUCK_AFTER_S:
+            # Claim the retry (matching the old start time) so only one poll, on any worker, re-queues it
+            claimed = conversations_collection.update_one(
+                {"_id": oid, "feedback_ready": False, "feedback_started_at": started_at},
+                {"$set": {"feedback_started_at": now}},
+            )
+            if claimed.modified_count:
+                full_convo = _load_full_conversation(conv_id)
+                if full_convo:
+                    _queue_evaluation(conv_id, full_convo)
+        return jsonify({"status": "pending"}), 202
+
+    grammar_feedback = convo.get("grammar_feedback")
+    if not isinstance(grammar_feedback, dict):
+        grammar_feedback = {}
+    return jsonify({"status": "ready", **_feedback_payload(grammar_feedback)}), 200
 
 
 
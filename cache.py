@@ -0,0 +1,99 @@
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+
+import google.generativeai as genai
+
+# -------------------------
+# Semantic reply cache
+# -------------------------
+# Short ESL replies to paraphrased prompts repeat a lot after the same AI line
+# (pool openers especially), so a near-duplicate user reply to exactly the same
+# AI line can reuse an earlier Gemini reply. The AI line is matched by hash and
+# only the user's reply is embedded, so "Yes" and "No" never look alike just
+# because they answer the same long question.
+# Replies are stored as the sentence list that was sent to TTS, so a hit replays
+# exactly the same per-sentence TTS cache entries too.
+EMBED_MODEL = os.getenv("SEMANTIC_CACHE_EMBED_MODEL", "models/text-embedding-004")
+SIMILARITY_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+MAX_ENTRIES_PER_CONTEXT = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "32"))
+MAX_CONTEXTS = int(os.getenv("SEMANTIC_CACHE_MAX_CONTEXTS", "1024"))
+ENABLED = os.getenv("SEMANTIC_CACHE", "1") not in ("0", "false", "False")
+
+Vector = List[float]
+
+# (scenario_key, hash of the AI line) -> recent (user embedding, reply sentences); LRU over contexts
+_entries: "OrderedDict[Tuple[str, str], Deque[Tuple[Vector, List[str]]]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _context_key(scenario_key: str, ai_line: str) -> Tuple[str, str]:
+    return scenario_key, hashlib.sha256(ai_line.strip().encode("utf-8")).hexdigest()
+
+
+def _normalize(v: Vector) -> Vector:
+    norm = math.sqrt(sum(x * x for x in v)) or 1.0
+    return [x / norm for x in v]
+
+
+def embed(text: str) -> Vector:
+    """Unit-length embedding of `text`, so cosine similarity is a plain dot product."""
+    resp = genai.embed_content(model=EMBED_MODEL, content=text, task_type="semantic_similarity")
+    return _normalize(resp["embedding"])
+
+
+def lookup(scenario_key: str, ai_line: str, user_text: str) -> Tuple[Optional[List[str]], Optional[Vector]]:
+    """
+    Return (cached_sentences, user_text_embedding) for a user reply to `ai_line`.
+    cached_sentences is None on a miss; pass the embedding back to store() so it isn't
+    computed twice. The reply is only embedded if replies to `ai_line` are cached,
+    so an unseen AI line costs nothing here. Empty replies are never looked up, and
+    embedding failures are treated as a miss with no embedding.
+    """
+    if not ENABLED or not user_text.strip():
+        return None, None
+    with _lock:
+        candidates = list(_entries.get(_context_key(scenario_key, ai_line), ()))
+    if not candidates:
+        return None, None
+
+    try:
+        vec = embed(user_text)
+    except Exception as e:
+        print(f"Semantic cache embed failed: {e}")
+        return None, None
+
+    best_score, best = 0.0, None
+    for cached_vec, sentences in candidates:
+        score = sum(a * b for a, b in zip(vec, cached_vec))
+        if score > best_score:
+            best_score, best = score, sentences
+
+    if best is not None and best_score >= SIMILARITY_THRESHOLD:
+        return best, vec
+    return None, vec
+
+
+def store(scenario_key: str, ai_line: str, user_text: str, sentences: List[str], vec: Optional[Vector] = None) -> None:
+    """
+    Remember a reply to `ai_line`, embedding `user_text` unless lookup() already did
+    (callers run this in the background, off the reply path). The oldest entries for
+    that line are dropped once it is full, and the least recently stored AI lines
+    once there are too many.
+    """
+    if not ENABLED or not user_text.strip() or not sentences:
+        return
+    if vec is None:
+        vec = embed(user_text)
+    key = _context_key(scenario_key, ai_line)
+    with _lock:
+        bucket = _entries.get(key)
+        if bucket is None:
+            bucket = _entries[key] = deque(maxlen=MAX_ENTRIES_PER_CONTEXT)
+        _entries.move_to_end(key)
+        bucket.append((vec, list(sentences)))
+        while len(_entries) > MAX_CONTEXTS:
+            _entries.popitem(last=False)
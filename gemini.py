@@ -2,8 +2,9 @@
 import os
 import json
 import random
+import re
 import sys
-from typing import Dict
+from typing import Dict, Iterable, Iterator
 
 import google.generativeai as genai
 from dotenv import load_dotenv
@@ -42,6 +43,49 @@ def ensure_model_exists(model_id: str) -> None:
             print("-", m.name)
         raise
 
+# Sentence boundary = terminal punctuation followed by whitespace (so "3.5" stays whole)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s+")
+# Long run-on sentences are flushed early so TTS never waits on more than this many words
+MAX_SEGMENT_WORDS = 15
+
+def _cap_words(text: str, max_words: int):
+    """
+    Cut `max_words`-word pieces off the front of `text`. Returns (pieces, remainder);
+    only whitespace-terminated words count, so a word still being streamed stays put.
+    """
+    pieces = []
+    if max_words:
+        head = re.compile(r"\s*(?:\S+\s+){%d}" % max_words)
+        m = head.match(text)
+        while m:
+            pieces.append(m.group().strip())
+            text = text[m.end():]
+            m = head.match(text)
+    return pieces, text
+
+def iter_sentences(text_chunks: Iterable[str], max_words: int = MAX_SEGMENT_WORDS) -> Iterator[str]:
+    """
+    Re-chunk streamed model text into whole sentences, yielding each one as soon as
+    its terminal punctuation arrives, or once it reaches `max_words` complete words.
+    Every sentence is capped the same way, so the split doesn't depend on chunking.
+    Whatever is left at the end is flushed as-is.
+    """
+    buf = ""
+    for piece in text_chunks:
+        buf += piece or ""
+        parts = _SENTENCE_END_RE.split(buf)
+        for sentence in parts[:-1]:
+            pieces, rest = _cap_words(sentence, max_words)
+            yield from pieces
+            if rest.strip():
+                yield rest.strip()
+
+        # The last word may still be mid-stream, so only count whitespace-terminated ones
+        pieces, buf = _cap_words(parts[-1], max_words)
+        yield from pieces
+    if buf.strip():
+        yield buf.strip()
+
 def load_scenarios(path: str) -> Dict:
     with open(path, "r") as f:
         return json.load(f)
@@ -1,4 +1,14 @@
+import fcntl
+import json
+import os
+import tempfile
 import random
+import threading
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
 import google.generativeai as genai
 from gemini import build_system_instruction, load_scenarios, MODEL_ID, SCENARIOS_PATH
 
@@ -8,80 +18,273 @@ try:
 except Exception:
     SCENARIOS = {}
 
+# Built once: lowercase title -> key, for O(1) lookups on /start_call
+_TITLE_INDEX = {v.get("title", "").lower(): k for k, v in SCENARIOS.items()}
+_SCENARIO_KEYS = list(SCENARIOS.keys())
+
+# Per-scenario prompt text, rendered once here and read-only afterwards
+# (shared by every request thread, so nothing formats it on the hot path)
+_FALLBACK_SYS_INSTR = (
+    "You are 'oli', a friendly ESL conversation partner. "
+    "Reply naturally and briefly, keeping sentences simple and human."
+)
+
+def _render_opener_prompt(s: Dict) -> str:
+    return (
+        "Start the call with ONE short, natural spoken line (≤ 35 words). "
+        "Do NOT include any speaker labels (no 'AI:', 'You:', etc.). "
+        "NO brackets/parentheses/placeholders; NO stage directions; NO emojis. "
+        "Just talk like a person on the phone.\n"
+        f"Setting: {s.get('setting', '')}\n"
+        f"Role: {s.get('role', '')}\n"
+        f"Stakes: {s.get('stakes', '')}"
+    )
+
+def _render_feedback_context(title: str, s: Dict) -> str:
+    return (
+        f"Scenario Context:\n"
+        f"- Title: {title}\n"
+        f"- Setting: {s.get('setting', '')}\n"
+        f"- Stakes: {s.get('stakes', '')}\n"
+        f"- Roles: {s.get('role', '')}\n\n"
+    )
+
+_SYS_INSTR = MappingProxyType({k: build_system_instruction(v) for k, v in SCENARIOS.items()})
+_OPENER_PROMPT = MappingProxyType({k: _render_opener_prompt(v) for k, v in SCENARIOS.items()})
+_FEEDBACK_CONTEXT = MappingProxyType({
+    k: _render_feedback_context(v.get("title", k), v) for k, v in SCENARIOS.items()
+})
+
 _model_cache = {}
 
+# Gemini context caching for the per-scenario system instruction:
+# cache_key -> (model bound to the cached content or None, refresh/retry time)
+# Off by default: the shipped system instructions are well below Gemini's minimum
+# cacheable size, so creation would only ever fail. Enable it for scenarios with
+# instructions long enough to qualify.
+USE_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") in ("1", "true", "True")
+CONTEXT_CACHE_TTL = timedelta(hours=1)
+CONTEXT_CACHE_REFRESH_MARGIN = timedelta(minutes=5)
+_context_cache: Dict[str, Tuple[Optional[genai.GenerativeModel], datetime]] = {}
+# Held across creation so concurrent first requests don't each create (and pay for) a cache
+_context_cache_lock = threading.Lock()
+
+# Pre-generated opening lines per scenario key (see warm_opener_cache)
+OPENERS_CACHE_PATH = os.getenv("OPENERS_CACHE_PATH", "openers.json")
+OPENERS_PER_SCENARIO = int(os.getenv("OPENERS_PER_SCENARIO", "10"))
+OPENER_WARMUP_WORKERS = 8
+_opener_cache: Dict[str, List[str]] = {}
+
 def find_scenario_key_by_title(title: str) -> str:
     """
     Map a human-readable scenario title to its internal key in SCENARIOS.
     Falls back to a random one if none match.
     """
-    if not title:
-        return random.choice(list(SCENARIOS.keys())) if SCENARIOS else "General"
-    for key, val in SCENARIOS.items():
-        if val.get("title", "").lower() == title.lower():
-            return key
-    return random.choice(list(SCENARIOS.keys())) if SCENARIOS else "General"
+    key = _TITLE_INDEX.get(title.lower()) if title else None
+    if key:
+        return key
+    return random.choice(_SCENARIO_KEYS) if _SCENARIO_KEYS else "General"
+
+
+def _create_cached_model(sys_inst: str):
+    """
+    Register the system instruction as Gemini cached content and return
+    (model bound to it, refresh-by time). Returns (None, retry-after time) when the
+    API refuses (e.g. the prefix is under the model's minimum cacheable size), so
+    callers fall back to a plain model without retrying on every request.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        cached = genai.caching.CachedContent.create(
+            model=MODEL_ID,
+            system_instruction=sys_inst,
+            ttl=CONTEXT_CACHE_TTL,
+        )
+        model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+    except Exception as e:
+        print(f"Gemini context cache unavailable, using plain model: {e}")
+        return None, now + CONTEXT_CACHE_TTL
+    # Refresh a little before the server-side TTL so requests never hit an expired cache
+    return model, now + CONTEXT_CACHE_TTL - CONTEXT_CACHE_REFRESH_MARGIN
 
 
 def get_model_for_scenario(scenario_key: str = "General"):
     """
     Return a Gemini model configured with a scenario-specific system instruction.
+    When context caching is available the instruction is served from a Gemini
+    cached-content object (refreshed lazily once its TTL runs low) instead of being
+    re-sent and re-processed on every turn.
     """
-    if scenario_key in SCENARIOS:
-        sys_inst = build_system_instruction(SCENARIOS[scenario_key])
-    else:
-        sys_inst = (
-            "You are 'oli', a friendly ESL conversation partner. "
-            "Reply naturally and briefly, keeping sentences simple and human."
-        )
+    sys_inst = _SYS_INSTR.get(scenario_key, _FALLBACK_SYS_INSTR)
 
     cache_key = f"{MODEL_ID}::{scenario_key}"
+    if USE_CONTEXT_CACHE:
+        with _context_cache_lock:
+            model, refresh_at = _context_cache.get(cache_key, (None, None))
+            if refresh_at is None or datetime.now(timezone.utc) >= refresh_at:
+                model, refresh_at = _create_cached_model(sys_inst)
+                _context_cache[cache_key] = (model, refresh_at)
+        if model is not None:
+            return model
+
     if cache_key not in _model_cache:
         _model_cache[cache_key] = genai.GenerativeModel(MODEL_ID, system_instruction=sys_inst)
     return _model_cache[cache_key]
 
 
-def gemini_opening_for_scenario(scenario_key: str) -> str:
+def _generate_opener(scenario_key: str) -> str:
     """
-    Ask Gemini to produce the first AI line for the selected scenario.
+    One live Gemini call for an opening line. Raises on API errors.
     """
     model = get_model_for_scenario(scenario_key)
     chat = model.start_chat()
 
-    s = SCENARIOS.get(scenario_key, {})
-    setting = s.get("setting", "")
-    role = s.get("role", "")
-    stakes = s.get("stakes", "")
+    prompt = _OPENER_PROMPT.get(scenario_key) or _render_opener_prompt({})
+
+    resp = chat.send_message(prompt)
+    return (getattr(resp, "text", "") or "").strip()
 
-    prompt = (
-        "Start the call with ONE short, natural spoken line (≤ 35 words). "
-        "Do NOT include any speaker labels (no 'AI:', 'You:', etc.). "
-        "NO brackets/parentheses/placeholders; NO stage directions; NO emojis. "
-        "Just talk like a person on the phone.\n"
-        f"Setting: {setting}\n"
-        f"Role: {role}\n"
-        f"Stakes: {stakes}"
-    )
+
+def gemini_opening_for_scenario(scenario_key: str) -> str:
+    """
+    Return the first AI line for the selected scenario.
+    Served from the pre-generated opener pool when available, otherwise asks Gemini.
+    """
+    cached = _opener_cache.get(scenario_key)
+    if cached:
+        return random.choice(cached)
 
     try:
-        resp = chat.send_message(prompt)
-        return (getattr(resp, "text", "") or "").strip() or "Let's begin. What’s happening around you?"
+        return _generate_opener(scenario_key) or "Let's begin. What’s happening around you?"
     except Exception as e:
         return f"(Gemini error creating opener: {e})"
-    
+
+
+def _load_opener_cache(path: str) -> Dict[str, List[str]]:
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return {k: v for k, v in data.items() if k in SCENARIOS and isinstance(v, list)}
+
+
+def _save_opener_cache(path: str) -> None:
+    # Unique temp file + atomic rename, so a concurrent reader never sees a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(_opener_cache, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def warm_opener_cache(per_scenario: int = OPENERS_PER_SCENARIO, path: str = OPENERS_CACHE_PATH,
+                      then=None) -> None:
+    """
+    Fill _opener_cache with `per_scenario` openers for every scenario.
+    Openers are deterministic in style per scenario, so they are generated once and
+    persisted to `path`; restarts reuse the file and only top up missing entries.
+
+    Every gunicorn worker calls this at import, so the whole warmup (including the
+    optional `then()` follow-up) runs under an exclusive lock on `path`.lock: the
+    first worker generates, the others wait and then just load the saved file.
+    """
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            _warm_opener_cache_locked(per_scenario, path)
+            if then is not None:
+                then()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _warm_opener_cache_locked(per_scenario: int, path: str) -> None:
+    _opener_cache.update(_load_opener_cache(path))
+
+    # Fan the missing openers out over a small pool so warmup takes about
+    # ceil(missing / workers) Gemini round-trips instead of one per opener.
+    with ThreadPoolExecutor(max_workers=OPENER_WARMUP_WORKERS) as ex:
+        futures = {
+            ex.submit(_generate_opener, key): key
+            for key in SCENARIOS
+            for _ in range(per_scenario - len(_opener_cache.get(key, [])))
+        }
+        generated = False
+        for fut in as_completed(futures):
+            key = futures[fut]
+            try:
+                text = fut.result()
+            except Exception as e:
+                print(f"Opener warmup failed for {key}: {e}")
+                continue
+            if text:
+                _opener_cache.setdefault(key, []).append(text)
+                generated = True
+
+    if generated:
+        try:
+            _save_opener_cache(path)
+        except OSError as e:
+            print(f"Could not persist opener cache to {path}: {e}")
+
+
+def feedback_context_for_scenario(scenario_key: str) -> str:
+    """The "Scenario Context" block of the evaluator prompt for a scenario."""
+    return _FEEDBACK_CONTEXT.get(scenario_key) or _render_feedback_context(scenario_key, {})
+
+
+def cached_openers() -> List[str]:
+    """Every opener currently in the pool, across all scenarios."""
+    return [text for texts in list(_opener_cache.values()) for text in texts]
+
+
+# Structured-output schema for the evaluator. Gemini decodes against it, so the
+# prompt only carries the rubric and the learner's lines.
+EVALUATOR_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "success_percentage": {"type": "INTEGER", "description": "Overall score, 0-100."},
+        "grammar_feedback": {
+            "type": "ARRAY",
+            "nullable": True,
+            "description": "One entry per learner sentence with an error; null if there are none.",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "before": {"type": "STRING", "description": "The learner's sentence with the error."},
+                    "after": {"type": "STRING", "description": "The corrected sentence."},
+                },
+                "required": ["before", "after"],
+            },
+        },
+        "grammar_issues": {"type": "INTEGER", "description": "Number of actual grammar mistakes found, 0 if none."},
+        "turns": {"type": "INTEGER", "description": "Number of learner utterances analyzed."},
+    },
+    "required": ["success_percentage", "grammar_feedback", "grammar_issues", "turns"],
+}
+
 
 def get_evaluator_model():
-    # A clean model that is NOT role-play; it only returns JSON.
+    # A clean model that is NOT role-play; it only returns JSON matching EVALUATOR_RESPONSE_SCHEMA.
+    cache_key = f"{MODEL_ID}::__evaluator__"
+    if cache_key in _model_cache:
+        return _model_cache[cache_key]
+
     generation_config = {
-        "response_mime_type": "application/json"
+        "response_mime_type": "application/json",
+        "response_schema": EVALUATOR_RESPONSE_SCHEMA,
     }
-    system_inst = (
-        "You are an ESL evaluator. You MUST return strictly valid JSON with the exact keys specified. "
-        "No prose, no backticks, no extra text—JSON only."
-    )
-    return genai.GenerativeModel(
+    system_inst = "You are an ESL evaluator of a learner's spoken English."
+    _model_cache[cache_key] = genai.GenerativeModel(
         MODEL_ID,  # or a more capable Gemini model if you prefer
         system_instruction=system_inst,
         generation_config=generation_config
     )
-
+    return _model_cache[cache_key]
@@ -0,0 +1,60 @@
+"""
+Local dev demo: convert an .m4a recording to .wav and transcribe it.
+Not imported by the server. Run from the repo root: python -m scripts.transcribe_demo
+"""
+import os
+import io
+from google.cloud import speech_v2
+from google.oauth2 import service_account
+from google.auth.transport.requests import Request
+
+from m4atowav import convert_m4a_to_wav
+
+# === CONFIG ===
+PROJECT_ID = "spring-radar-474120-c4"
+KEY_PATH = "/Users/andywoochanjung/Desktop/RingApp-Backend/config/spring-radar-474120-c4-70f2fa862484.json"
+CLOUD_SCOPE = ["https://www.googleapis.com/auth/cloud-platform"]
+
+
+def transcribe_audio(wav_path: str):
+    """Transcribe a WAV file using Google Cloud Speech-to-Text v2."""
+    # load + refresh credentials
+    base = service_account.Credentials.from_service_account_file(KEY_PATH)
+    scoped = base.with_scopes(CLOUD_SCOPE).with_quota_project(PROJECT_ID)
+    scoped.refresh(Request())
+    print("🔐 Authenticated as:", scoped.service_account_email)
+
+    # set up client
+    client = speech_v2.SpeechClient(credentials=scoped)
+
+    with io.open(wav_path, "rb") as f:
+        audio_bytes = f.read()
+
+    config = speech_v2.RecognitionConfig(
+        auto_decoding_config=speech_v2.AutoDetectDecodingConfig(),
+        language_codes=["en-US"],
+        model="latest_long",  # use long for >15s audio
+    )
+
+    request = speech_v2.RecognizeRequest(
+        recognizer=f"projects/{PROJECT_ID}/locations/global/recognizers/_",
+        config=config,
+        content=audio_bytes,
+    )
+
+    response = client.recognize(request=request)
+
+    print("\n=== TRANSCRIPTION ===")
+    if not response.results:
+        print("❌ No results found.")
+    for r in response.results:
+        if r.alternatives:
+            print("🗣️", r.alternatives[0].transcript)
+    print("=====================\n")
+
+
+if __name__ == "__main__":
+    m4a_path = "Recording (3).m4a"  # replace with your incoming file path
+    wav_path = convert_m4a_to_wav(m4a_path)
+    transcribe_audio(wav_path)
+    os.remove(wav_path)  # cleanup temporary wav
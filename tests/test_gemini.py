@@ -0,0 +1,29 @@
+import random
+
+from gemini import MAX_SEGMENT_WORDS, iter_sentences
+
+TEXT = (
+    "Okay, listen. The smoke is coming under the door and I can hear people shouting "
+    "somewhere down the hall on the other side of the building right now! "
+    "Tell me what you see.   Is the stairwell clear, or do we wait for the crew "
+    "that is on its way with the ladder and the hoses and everything else they need? "
+    "Stay low. Version 3.5 of the plan says\nwe go left"
+)
+
+
+def _chunked(text, seed):
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(text)), rng.randint(1, 40)))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+def test_streamed_split_matches_whole_text_split():
+    whole = list(iter_sentences([TEXT]))
+    for seed in range(200):
+        assert list(iter_sentences(_chunked(TEXT, seed))) == whole
+    assert list(iter_sentences(TEXT)) == whole  # one character per chunk
+
+
+def test_every_segment_is_capped():
+    for seg in iter_sentences([TEXT]):
+        assert 0 < len(seg.split()) <= MAX_SEGMENT_WORDS